@@ -1,54 +1,89 @@
 # bingx_client.py — финальная версия SDK для BingX Swap V2
 
 import time
+import concurrent.futures
+import threading
 import hmac
 import hashlib
 import requests
 import json
+import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import List, Dict, Optional
 from decimal import Decimal
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Общий лимит одновременных подписанных запросов к BingX на весь процесс
+MAX_CONCURRENT_REQUESTS = 20
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+# Справочник контрактов перезагружается не чаще, если символа в нём нет или загрузка упала
+PRECISION_RETRY_SEC = 300
+
+logger = logging.getLogger(__name__)
+
+
+def _response_json(response):
+    return orjson.loads(response.content) if orjson else response.json()
+
 class BingxClient:
     def __init__(self, api_key: str, api_secret: str, testnet: bool = False):
         self.api_key = api_key
         self.api_secret = api_secret
+        self._api_secret_bytes = api_secret.encode("utf-8")
         self.testnet = testnet
+        self._sym_cache: Dict[str, str] = {}
+        self._precision_cache: Dict[str, tuple] = {}
+        self._precision_loaded_at = 0.0
         self.BASE_URL = "https://open-api-vst.bingx.com" if testnet else "https://open-api.bingx.com"
+        self.session = requests.Session()
+        self.session.headers.update({'X-BX-APIKEY': self.api_key, 'Connection': 'keep-alive'})
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=32,
+            max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504))
+        )
+        self.session.mount("https://", adapter)
         self.time_offset = self.get_server_time_offset()
 
     def _to_bingx_symbol(self, symbol: str) -> str:
-        s = symbol.replace("-", "")
-        s = s.replace("/", "")
-        s = s.replace("USDT", "-USDT")
+        s = self._sym_cache.get(symbol)
+        if s is None:
+            s = self._sym_cache[symbol] = symbol.replace("-", "").replace("/", "").replace("USDT", "-USDT")
         return s
 
     def _sign(self, query: str) -> str:
-        return hmac.new(self.api_secret.encode("utf-8"),
-                        query.encode("utf-8"),
-                        hashlib.sha256).hexdigest()
+        # hmac.digest — однопроходный вызов OpenSSL без создания HMAC-объекта
+        return hmac.digest(self._api_secret_bytes, query.encode("utf-8"), "sha256").hex()
 
     def parseParam(self, paramsMap: dict) -> str:
-        sortedKeys = sorted(paramsMap)
-        paramsStr = "&".join(f"{k}={paramsMap[k]}" for k in sortedKeys)
-        timestamp = str(int(time.time() * 1000))
+        # BingX подписывает сырую строку параметров, поэтому urlencode здесь не подходит
+        paramsStr = "&".join([f"{k}={v}" for k, v in sorted(paramsMap.items())])
+        timestamp = int(time.time() * 1000)
         return f"{paramsStr}&timestamp={timestamp}" if paramsStr else f"timestamp={timestamp}"
 
-    def _request(self, method: str, path: str, params=None, data=None):
+    def _request(self, method: str, path: str, params=None, data=None, timeout: int = 10):
         if params is None:
             params = {}
         query_string = self.parseParam(params)
         signature = self._sign(query_string)
         url = f"{self.BASE_URL}{path}?{query_string}&signature={signature}"
-        headers = {'X-BX-APIKEY': self.api_key}
-        response = requests.request(method, url, headers=headers, data=data or {})
+        # Слот общий на процесс: без таймаута зависшее соединение заняло бы его навсегда
+        with _request_slots:
+            response = self.session.request(method, url, data=data or {}, timeout=timeout)
         response.raise_for_status()
-        return response.json()
+        return _response_json(response)
 
     def _public_request(self, path: str, params=None, timeout: int = 10):
         url = f"{self.BASE_URL}{path}"
-        r = requests.get(url, params=params, timeout=timeout)
+        r = self.session.get(url, params=params, timeout=timeout)
         r.raise_for_status()
-        return r.json()
+        return _response_json(r)
 
     def get_server_time_offset(self):
         path = "/openApi/swap/v2/server/time"
@@ -102,18 +137,43 @@ class BingxClient:
         }
         return self._request("DELETE", path, params)
 
+    def cancel_all_orders(self, symbol: str):
+        """Отменить все открытые ордера по символу одним запросом"""
+        path = "/openApi/swap/v2/trade/allOpenOrders"
+        params = {
+            'symbol': self._to_bingx_symbol(symbol),
+            "timestamp": int(time.time() * 1000) + self.time_offset
+        }
+        return self._request("DELETE", path, params)
+
+    def cancel_orders_batch(self, symbol: str, order_ids):
+        """Отменить пачку ордеров по списку orderId"""
+        path = "/openApi/swap/v2/trade/batchOrders"
+        params = {
+            'symbol': self._to_bingx_symbol(symbol),
+            "timestamp": int(time.time() * 1000) + self.time_offset,
+            'orderIdList': json.dumps([int(i) for i in order_ids])
+        }
+        return self._request("DELETE", path, params)
+
     def cancel_existing_orders(self, symbol: str):
         """Отменить все открытые ордера по символу"""
-        orders = self.get_open_orders(symbol)
-        success = 0
-        for order in orders:
-            order_id = order.get('orderId')
-            if order_id:
-                resp = self.cancel_order(symbol, order_id)
-                if resp.get('code') == 0:
-                    success += 1
-                time.sleep(0.3)
-        return success
+        try:
+            resp = self.cancel_all_orders(symbol)
+            if resp.get('code') == 0:
+                return len((resp.get('data') or {}).get('success') or [])
+            logger.warning(f"cancel_all_orders failed for {symbol}: {resp}, falling back to batch cancel")
+        except Exception as e:
+            logger.warning(f"cancel_all_orders failed for {symbol}: {e}, falling back to batch cancel")
+
+        # Запасной путь: одна пачечная отмена по списку orderId
+        order_ids = [o['orderId'] for o in self.get_open_orders(symbol) if o.get('orderId')]
+        if not order_ids:
+            return 0
+        resp = self.cancel_orders_batch(symbol, order_ids)
+        if resp.get('code') == 0:
+            return len((resp.get('data') or {}).get('success') or [])
+        return 0
 
     def get_trades_history(self, days=180):
         """Получить историю сделок за последние days дней"""
@@ -185,6 +245,25 @@ class BingxClient:
 
         return self._request("POST", "/openApi/swap/v2/trade/order", params)
 
+    def get_precision(self, symbol: str) -> Optional[tuple]:
+        """(pricePrecision, quantityPrecision) контракта; справочник грузится один раз на клиента"""
+        s = self._to_bingx_symbol(symbol)
+        if s not in self._precision_cache and time.time() - self._precision_loaded_at >= PRECISION_RETRY_SEC:
+            # Отметка ставится и при неудаче: промах не качает весь справочник на каждый вызов
+            self._precision_loaded_at = time.time()
+            try:
+                data = self._public_request("/openApi/swap/v2/quote/contracts")
+                if data.get("code") == 0:
+                    for c in data.get("data", []):
+                        self._precision_cache[c["symbol"]] = (int(c["pricePrecision"]), int(c["quantityPrecision"]))
+                else:
+                    logger.warning(f"Contracts request failed: {data.get('msg')}")
+            except Exception as e:
+                logger.warning(f"Failed to load contract precision: {e}")
+            if s not in self._precision_cache:
+                logger.warning(f"No contract precision for {s}, falling back to price decimals")
+        return self._precision_cache.get(s)
+
     def count_decimal_places(self, number: float) -> int:
         s = str(number).rstrip('0')
         if '.' in s:
@@ -212,7 +291,7 @@ class BingxClient:
         # Существующая реализация осталась без изменений
         # (твой оригинальный код)
         print(mark_price)
-        precision = self.count_decimal_places(mark_price)
+        contract_precision = self.get_precision(symbol)
 
         if side == "short":
             tp_side = "BUY"
@@ -224,10 +303,14 @@ class BingxClient:
         if both == True:
             pos_side = 'BOTH'
         answer = []
-        qty_round = 0 if precision >= 3 else 2 if precision == 2 else 3 if precision == 1 else 4
+        if contract_precision:
+            qty_round = contract_precision[1]
+        else:
+            precision = self.count_decimal_places(mark_price)
+            qty_round = 0 if precision >= 3 else 2 if precision == 2 else 3 if precision == 1 else 4
         qty_tp = round(qty / len(tp_levels), qty_round)
 
-        for tp in tp_levels:
+        def place_tp(tp):
             params = {
                 "symbol": self._to_bingx_symbol(symbol),
                 "side": tp_side,
@@ -240,11 +323,15 @@ class BingxClient:
             }
             try:
                 resp = self._request("POST", "/openApi/swap/v2/trade/order", params)
-                answer.append(resp)
                 print(f"[TP] Установлен тейк-профит {tp}")
+                return resp
             except Exception as e:
                 print("[TP ERROR]", e)
-                answer.append({"code": 1, "msg": str(e)})
+                return {"code": 1, "msg": str(e)}
+
+        # TP независимы — отправляем параллельно; map сохраняет порядок ответов
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(tp_levels)) as executor:
+            answer = list(executor.map(place_tp, tp_levels))
 
         return answer
 
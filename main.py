@@ -1,9 +1,19 @@
+import atexit
 import time
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import logging.handlers
+import queue
+import sqlite3
 import concurrent.futures
+import functools
+from itertools import islice
+from dataclasses import dataclass, field, fields, asdict
 from datetime import datetime, timedelta
+from typing import Dict, List, Set
 from pathlib import Path
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, ConversationHandler, MessageHandler, Filters
@@ -11,12 +21,24 @@ import threading
 import asyncio
 from bingx_client import BingxClient
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 # =====================================================
 # ================== CONFIG ===========================
 # =====================================================
 VOL_PERIOD = 60
-USERS_FILE = Path("users.json")
+USERS_FILE = Path("users.json")  # старый формат, импортируется в USERS_DB при первом запуске
+USERS_DB = Path("users.db")
 LOG_FILE = Path("bot.log")
+COMMANDS_VERSION_FILE = Path(".cmdsver")
 TELEGRAM_TOKEN = ""
 bot = Bot(token=TELEGRAM_TOKEN)
 
@@ -25,26 +47,183 @@ bot = Bot(token=TELEGRAM_TOKEN)
 # =====================================================
 
 
+# Запись логов уходит в фоновый поток: сканер и сделки не ждут диск
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [logging.FileHandler(LOG_FILE), logging.StreamHandler()]
+for _h in _log_handlers:
+    _h.setFormatter(_log_formatter)
+_log_queue = queue.Queue(-1)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# QueueHandler.prepare() вшивает отформатированный текст в record.msg; префикс добавят
+# обработчики слушателя, иначе basicConfig подставит свой формат и он задвоится
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler(LOG_FILE), logging.StreamHandler()]
+    handlers=[_queue_handler]
 )
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
-def load_users():
+@dataclass(slots=True)
+class UserCfg:
+    """Настройки пользователя; в users.json хранятся как словарь полей"""
+    trading_enabled: bool = False
+    testnet: bool = False
+    api_key: str = ""
+    api_secret: str = ""
+    leverage: int = 10
+    margin_usdt: float = 50
+    signals_4h_enabled: bool = True
+    signals_24h_enabled: bool = True
+    price_oi_ratio: float = 0.5
+    stop_loss_pct: float = 2.0
+    take_profit_pcts: List[float] = field(default_factory=lambda: [4.0, 6.0])
+    trailing_enabled: bool = False
+    trailing_activation_pct: float = 1.5
+    trailing_rate_pct: float = 0.5
+    volume_filter_enabled: bool = False
+    volume_multiplier: float = 2.0
+    # В памяти blacklist — set (O(1) проверка), на диске остаётся списком
+    blacklist: Set[str] = field(default_factory=set)
+    last_signal_time: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise TypeError(f"User settings must be a dict, got {type(data).__name__}")
+        cfg = cls(**{k: v for k, v in data.items() if k in _USER_FIELDS})
+        cfg.blacklist = set(cfg.blacklist)
+        return cfg
+
+_USER_FIELDS = frozenset(f.name for f in fields(UserCfg))
+_DEFAULT_CFG = UserCfg()  # только для чтения: отображение настроек незарегистрированного чата
+
+def _json_default(obj):
+    if isinstance(obj, UserCfg):
+        return asdict(obj)
+    if isinstance(obj, set):
+        return sorted(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _dump_user(user):
+    if orjson:
+        return orjson.dumps(user, default=_json_default)
+    return json.dumps(user, ensure_ascii=False, default=_json_default).encode("utf-8")
+
+def _load_json(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def _open_users_db():
+    conn = sqlite3.connect(USERS_DB, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS users(chat_id TEXT PRIMARY KEY, data BLOB)")
+    return conn
+
+def _load_users_json():
+    """Старый формат: все пользователи одним users.json (нужен для разовой миграции)"""
     if USERS_FILE.exists():
         try:
-            return json.loads(USERS_FILE.read_text(encoding="utf-8"))
-        except json.JSONDecodeError:
+            loaded = _load_json(USERS_FILE.read_bytes())
+            if not isinstance(loaded, dict):
+                raise TypeError(f"expected an object, got {type(loaded).__name__}")
+        except (ValueError, TypeError):  # JSONDecodeError (и orjson) — подкласс ValueError
             logger.error("Corrupted users.json, starting fresh")
             return {}
+        migrated = {}
+        for chat_id, data in loaded.items():
+            try:
+                migrated[chat_id] = UserCfg.from_dict(data)
+            except (ValueError, TypeError):
+                logger.error(f"Corrupted settings for {chat_id} in {USERS_FILE}, skipping")
+        return migrated
     return {}
 
-def save_users(users_dict):
-    USERS_FILE.write_text(json.dumps(users_dict, indent=4, ensure_ascii=False), encoding="utf-8")
+# PRAGMA user_version: 0 — новая БД, users.json в неё ещё не импортирован
+USERS_DB_VERSION = 1
+
+def load_users():
+    loaded = {}
+    for chat_id, data in users_db.execute("SELECT chat_id, data FROM users"):
+        try:
+            loaded[chat_id] = UserCfg.from_dict(_load_json(data))
+        except (ValueError, TypeError):
+            logger.error(f"Corrupted settings for {chat_id} in {USERS_DB}, skipping")
+
+    (version,) = users_db.execute("PRAGMA user_version").fetchone()
+    if version >= USERS_DB_VERSION:
+        return loaded
+
+    # Первый запуск на SQLite: переносим пользователей из users.json ровно один раз.
+    # Пустая таблица после /stop всех пользователей — не повод импортировать старый файл заново
+    migrated = {} if loaded else _load_users_json()
+    with DB_LOCK:
+        users_db.execute("BEGIN")
+        users_db.executemany("REPLACE INTO users VALUES(?, ?)",
+                             [(chat_id, _dump_user(user)) for chat_id, user in migrated.items()])
+        users_db.execute(f"PRAGMA user_version = {USERS_DB_VERSION}")
+        users_db.execute("COMMIT")
+    if migrated:
+        logger.info(f"Migrated {len(migrated)} users from {USERS_FILE} to {USERS_DB}")
+    return loaded or migrated
+
+def schedule_save(chat_id):
+    """Пометить пользователя изменённым; его строку запишет фоновый поток"""
+    with USERS_LOCK:
+        _dirty_ids.add(chat_id)
+    _dirty.set()
+
+def _users_writer():
+    while True:
+        _dirty.wait()
+        time.sleep(SAVE_DEBOUNCE_SEC)  # склеиваем серию изменений в одну запись
+        try:
+            _flush_users()
+        except Exception as e:
+            logger.error(f"Failed to save users: {e}")
+
+def _flush_users():
+    """Записать в БД только изменённых пользователей (удалённые — удалить)"""
+    with USERS_LOCK:
+        _dirty.clear()
+        if not _dirty_ids:
+            return
+        changed = []
+        removed = []
+        for chat_id in _dirty_ids:
+            user = users.get(chat_id)
+            if user is None:
+                removed.append((chat_id,))
+            else:
+                changed.append((chat_id, _dump_user(user)))
+        pending = set(_dirty_ids)
+        _dirty_ids.clear()
 
+    try:
+        with DB_LOCK:
+            users_db.execute("BEGIN")
+            users_db.executemany("REPLACE INTO users VALUES(?, ?)", changed)
+            users_db.executemany("DELETE FROM users WHERE chat_id = ?", removed)
+            users_db.execute("COMMIT")
+    except Exception:
+        if users_db.in_transaction:
+            users_db.execute("ROLLBACK")
+        # Не теряем изменения: повторим запись на следующем проходе
+        with USERS_LOCK:
+            _dirty_ids.update(pending)
+        _dirty.set()
+        raise
+
+SAVE_DEBOUNCE_SEC = 1.0
+USERS_LOCK = threading.RLock()
+DB_LOCK = threading.Lock()
+_dirty = threading.Event()
+_dirty_ids = set()
+users_db = _open_users_db()
 users = load_users()
+threading.Thread(target=_users_writer, daemon=True).start()
+atexit.register(_flush_users)  # не терять отложенную запись при остановке
 
 BINANCE_FAPI_URL = "https://fapi.binance.com"
 
@@ -56,12 +235,103 @@ OI_24H_THRESHOLD = 16.0
 
 MIN_OI_USDT = 5_000_00
 SIGNAL_COOLDOWN_HOURS = 3
+SYMBOL_COOLDOWN_SEC = 30 * 60  # после разосланного сигнала символ не сканируется это время
 REQUEST_TIMEOUT = 10
+SCAN_WORKERS = 20
+SYMBOLS_TTL_SEC = 3600
+OI_CACHE_SEC = 300      # openInterestHist обновляется раз в 5 минут
+KLINES_CACHE_SEC = 60
+BINANCE_WEIGHT_PER_MIN = 2000  # запас от IP-лимита Binance (2400/мин)
+
+BINANCE_SESSION = requests.Session()
+BINANCE_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=2 * SCAN_WORKERS + 8,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504))
+))
+
+# Общий пул для открытия сделок (вместо нового ThreadPoolExecutor на каждый сигнал)
+TRADE_EXEC = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='trade')
+atexit.register(TRADE_EXEC.shutdown, wait=True)
+# Пул для параллельной загрузки klines, пока поток сканера грузит OI
+FETCH_EXEC = concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_WORKERS)
 
 # =====================================================
 # ================== UTILS ============================
 # =====================================================
 
+def ttl_cache(seconds):
+    """Кэширует результат функции без аргументов на seconds секунд.
+    Если обновление упало, а старое значение есть — возвращает его."""
+    def decorator(func):
+        value = None
+        expiry = 0.0
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper():
+            nonlocal value, expiry
+            with lock:
+                if time.time() >= expiry:
+                    try:
+                        value = func()
+                    except Exception as e:
+                        if value is None:
+                            raise
+                        logger.error(f"{func.__name__} refresh failed, using cached value: {e}")
+                    expiry = time.time() + seconds
+                return value
+        return wrapper
+    return decorator
+
+def bucket_cache(seconds):
+    """Кэширует результат по аргументам в пределах окна time // seconds.
+    Записи прошлых окон удаляются при первой записи в новое окно."""
+    def decorator(func):
+        cache = {}
+        current = 0
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            nonlocal current
+            bucket = int(time.time() // seconds)
+            with lock:
+                hit = cache.get(args)
+            if hit is not None and hit[0] == bucket:
+                return hit[1]
+            value = func(*args)
+            with lock:
+                if bucket > current:
+                    cache.clear()  # устаревшие окна и делистнутые символы
+                    current = bucket
+                cache[args] = (bucket, value)
+            return value
+        return wrapper
+    return decorator
+
+class RateLimiter:
+    """Token bucket по весу запросов: не больше weight_per_min в минуту"""
+
+    def __init__(self, weight_per_min):
+        self.capacity = weight_per_min
+        self.rate = weight_per_min / 60.0
+        self._tokens = float(weight_per_min)
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, weight=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= weight:
+                    self._tokens -= weight
+                    return
+                wait = (weight - self._tokens) / self.rate
+            time.sleep(wait)
+
 def pct(now, past):
     return 0.0 if past == 0 else (now - past) / past * 100.0
 
@@ -75,124 +345,174 @@ def send_alert(chat_id, text, parse_mode="HTML"):
 
         # 🚫 Пользователь заблокировал бота → удаляем из базы
         if "Forbidden" in error_text and "blocked by the user" in error_text:
-            users = load_users()
-            chat_id_str = str(chat_id)
+            with USERS_LOCK:
+                removed = users.pop(str(chat_id), None)
+            if removed is not None:
+                schedule_save(str(chat_id))
+                drop_client(str(chat_id))
+                logger.info(f"User {chat_id} removed from users (bot blocked)")
 
-            if chat_id_str in users:
-                del users[chat_id_str]
-                save_users(users)
-                logger.info(f"User {chat_id} removed from users.json (bot blocked)")
+BINANCE_LIMITER = RateLimiter(BINANCE_WEIGHT_PER_MIN)
 
-def binance_get(endpoint, params=None):
+def binance_get(endpoint, params=None, weight=1):
+    BINANCE_LIMITER.acquire(weight)
     url = BINANCE_FAPI_URL + endpoint
-    r = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
+    r = BINANCE_SESSION.get(url, params=params, timeout=REQUEST_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content) if orjson else r.json()
 
 # =====================================================
 # ================== DATA =============================
 # =====================================================
 
+def _is_usdt_perpetual(s):
+    return s["contractType"] == "PERPETUAL" and s["quoteAsset"] == "USDT" and s["status"] == "TRADING"
+
+@ttl_cache(SYMBOLS_TTL_SEC)
 def get_symbols():
-    data = binance_get("/fapi/v1/exchangeInfo")
-    return [
-        s["symbol"]
-        for s in data["symbols"]
-        if s["contractType"] == "PERPETUAL"
-        and s["quoteAsset"] == "USDT"
-        and s["status"] == "TRADING"
-    ]
+    if ijson is None:
+        data = binance_get("/fapi/v1/exchangeInfo")
+        return [s["symbol"] for s in data["symbols"] if _is_usdt_perpetual(s)]
+
+    # exchangeInfo большой: разбираем потоком и не строим весь JSON в памяти
+    BINANCE_LIMITER.acquire(1)
+    url = BINANCE_FAPI_URL + "/fapi/v1/exchangeInfo"
+    with BINANCE_SESSION.get(url, timeout=REQUEST_TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True  # поток может прийти в gzip
+        return [s["symbol"] for s in ijson.items(r.raw, "symbols.item") if _is_usdt_perpetual(s)]
 
 def get_oi_hist(symbol, limit):
     return binance_get("/futures/data/openInterestHist", {"symbol": symbol, "period": "5m", "limit": limit})
 
 def get_klines(symbol, limit):
-    return binance_get("/fapi/v1/klines", {"symbol": symbol, "interval": "5m", "limit": limit})
+    # Вес klines у Binance растёт с limit: <100 → 1, <500 → 2, <=1000 → 5
+    weight = 1 if limit < 100 else 2 if limit < 500 else 5
+    return binance_get("/fapi/v1/klines", {"symbol": symbol, "interval": "5m", "limit": limit}, weight=weight)
+
+# В кэше скана — только три нужные точки (сейчас, 4h и 24h назад), а не сырые 288 записей.
+# 4h-окно (48 свечей по 5m) — суффикс 24h-ряда, отдельный запрос не нужен
+@bucket_cache(OI_CACHE_SEC)
+def get_oi_points(symbol):
+    """sumOpenInterestValue сейчас, 4h и 24h назад; None, если истории меньше суток"""
+    oi = get_oi_hist(symbol, 288)
+    if len(oi) < 288:
+        return None
+    return float(oi[-1]["sumOpenInterestValue"]), float(oi[-48]["sumOpenInterestValue"]), float(oi[0]["sumOpenInterestValue"])
+
+@bucket_cache(KLINES_CACHE_SEC)
+def get_price_points(symbol):
+    """Цена закрытия сейчас, 4h и 24h назад"""
+    klines = get_klines(symbol, 288)
+    return float(klines[-1][4]), float(klines[-48][4]), float(klines[0][4])
 
 # =====================================================
 # ================== CORE LOGIC =======================
 # =====================================================
 
-def check_symbol(symbol):
+def get_symbol_metrics(symbol):
+    """Рост OI и цены символа за 4h/24h; None, если данных мало или OI ниже MIN_OI_USDT"""
     try:
-        oi_4h = get_oi_hist(symbol, 48)
-        oi_24h = get_oi_hist(symbol, 288)
-        if len(oi_24h) < 288:
+        price_future = FETCH_EXEC.submit(get_price_points, symbol)
+        oi_points = get_oi_points(symbol)
+        if oi_points is None:
             print('lenoi error')
             return None
 
-        oi_now = float(oi_4h[-1]["sumOpenInterestValue"])
-        oi_4h_ago = float(oi_4h[0]["sumOpenInterestValue"])
-        oi_24h_ago = float(oi_24h[0]["sumOpenInterestValue"])
+        oi_now, oi_4h_ago, oi_24h_ago = oi_points
         if oi_now < MIN_OI_USDT:
             print('oi min error')
             return None
 
-        oi_growth_4h = pct(oi_now, oi_4h_ago)
-        oi_growth_24h = pct(oi_now, oi_24h_ago)
-
-        klines_4h = get_klines(symbol, 48)
-        klines_24h = get_klines(symbol, 288)
-
-        price_now = float(klines_4h[-1][4])
-        price_4h_ago = float(klines_4h[0][4])
-        price_24h_ago = float(klines_24h[0][4])
+        price_now, price_4h_ago, price_24h_ago = price_future.result()
 
-        price_growth_4h = pct(price_now, price_4h_ago)
-        price_growth_24h = pct(price_now, price_24h_ago)
+        return {
+            "symbol": symbol,
+            "oi_growth_4h": pct(oi_now, oi_4h_ago),
+            "oi_growth_24h": pct(oi_now, oi_24h_ago),
+            "price_growth_4h": pct(price_now, price_4h_ago),
+            "price_growth_24h": pct(price_now, price_24h_ago),
+            "price_now": price_now,
+            "oi_now": oi_now
+        }
 
-        
+    except Exception as e:
+        logger.error(f"Error checking {symbol}: {e}")
+        return None
+
+# symbol -> time.time() последнего разосланного сигнала
+_COOLDOWN = {}
+# Символы в SIGNAL_QUEUE, ещё не разосланные: _COOLDOWN для них появится позже,
+# а следующий скан не должен поставить их в очередь повторно
+_PENDING = set()
+_PENDING_LOCK = threading.Lock()
+
+def passes_oi_thresholds(metrics):
+    """Пороги по OI не зависят от пользователя — отбираем символы одним проходом по скану"""
+    return metrics["oi_growth_4h"] >= OI_4H_THRESHOLD or metrics["oi_growth_24h"] >= OI_24H_THRESHOLD
+
+def dispatch_signal(base_signal):
+    """Рассылка сигнала по символу и открытие сделок согласно настройкам пользователей"""
+    symbol = base_signal["symbol"]
+    oi_growth_4h = base_signal["oi_growth_4h"]
+    oi_growth_24h = base_signal["oi_growth_24h"]
+    price_growth_4h = base_signal["price_growth_4h"]
+    price_growth_24h = base_signal["price_growth_24h"]
+    oi_4h_hit = oi_growth_4h >= OI_4H_THRESHOLD
+    oi_24h_hit = oi_growth_24h >= OI_24H_THRESHOLD
 
+    try:
         # Обработка пользователей (синхронно, как в старом коде)
-        users = load_users()  # Загружаем свежие данные
-        for chat_id_str, user_data in list(users.items()):
+        with USERS_LOCK:
+            users_snapshot = list(users.items())
+        for chat_id_str, user_data in users_snapshot:
             
-            price_oi_ratio = user_data.get("price_oi_ratio", 0.5)
-            allow_4h = user_data.get("signals_4h_enabled", True)
-            allow_24h = user_data.get("signals_24h_enabled", True)
-            
-            signal_4h = oi_growth_4h >= OI_4H_THRESHOLD and price_growth_4h <= oi_growth_4h * price_oi_ratio and allow_4h
-            signal_24h = oi_growth_24h >= OI_24H_THRESHOLD and price_growth_24h <= oi_growth_24h * price_oi_ratio and allow_24h
+            price_oi_ratio = user_data.price_oi_ratio
+
+            signal_4h = oi_4h_hit and user_data.signals_4h_enabled and price_growth_4h <= oi_growth_4h * price_oi_ratio
+            signal_24h = oi_24h_hit and user_data.signals_24h_enabled and price_growth_24h <= oi_growth_24h * price_oi_ratio
 
             if not (signal_4h or signal_24h):
-                return None
-
-            period = "4h" if signal_4h else "24h"
-
-            signal_data = {
-                "symbol": symbol,
-                "period": period,
-                "oi_growth_4h": oi_growth_4h,
-                "oi_growth_24h": oi_growth_24h,
-                "price_growth_4h": price_growth_4h,
-                "price_growth_24h": price_growth_24h,
-                "price_now": price_now,
-                "oi_now": oi_now
-            }
-        
-        
+                continue
+
+            # У каждого пользователя свой экземпляр: период зависит от его настроек
+            signal_data = dict(base_signal, period="4h" if signal_4h else "24h")
+
             chat_id = int(chat_id_str)
             send_alert(chat_id, generate_alert_text(signal_data))
+            _COOLDOWN[symbol] = time.time()
 
-            if not user_data.get("trading_enabled", False):
+            if not user_data.trading_enabled:
                 continue
 
-            last_signals = user_data.get("last_signal_time", {})
+            last_signals = user_data.last_signal_time
             if symbol in last_signals and datetime.utcnow() - datetime.fromisoformat(last_signals[symbol]) < timedelta(hours=SIGNAL_COOLDOWN_HOURS):
                 continue
 
-            last_signals[symbol] = datetime.utcnow().isoformat()
-            user_data["last_signal_time"] = last_signals
-            save_users(users)
+            with USERS_LOCK:
+                last_signals[symbol] = datetime.utcnow().isoformat()
+            schedule_save(chat_id_str)
 
-            if symbol in user_data.get("blacklist", []):
+            if symbol in user_data.blacklist:
                 continue
 
             # Открытие сделки в отдельном потоке
-            concurrent.futures.ThreadPoolExecutor().submit(open_trade_for_user, chat_id_str, signal_data)
+            TRADE_EXEC.submit(open_trade_for_user, chat_id_str, signal_data)
 
     except Exception as e:
-        logger.error(f"Error checking {symbol}: {e}")
+        logger.error(f"Error dispatching {symbol}: {e}")
+
+SIGNAL_QUEUE = queue.Queue()
+
+def signal_notifier():
+    """Фоновый поток: разбирает сигналы из SIGNAL_QUEUE и рассылает их пользователям"""
+    while True:
+        signal = SIGNAL_QUEUE.get()
+        try:
+            dispatch_signal(signal)
+        finally:
+            with _PENDING_LOCK:
+                _PENDING.discard(signal["symbol"])
 
 def generate_alert_text(signal):
     return (
@@ -212,9 +532,46 @@ def check_volume_filter(symbol, multiplier):
     klines = get_klines(symbol, VOL_PERIOD)
     if len(klines) < VOL_PERIOD:
         return False
-    volumes = [float(k[5]) for k in klines[:-1]]
-    avg_volume = sum(volumes) / len(volumes)
-    return float(klines[-1][5]) >= avg_volume * multiplier
+    total_volume = sum(float(k[5]) for k in islice(klines, len(klines) - 1))
+    return float(klines[-1][5]) * (len(klines) - 1) >= total_volume * multiplier
+
+CLIENTS = {}
+CLIENT_LOCK = threading.Lock()
+TIME_OFFSET_REFRESH_SEC = 30 * 60
+
+def _client_matches(bx, user_data):
+    return (bx is not None and bx.api_key == user_data.api_key
+            and bx.api_secret == user_data.api_secret and bx.testnet == user_data.testnet)
+
+def get_client(chat_id_str, user_data):
+    """Один BingxClient на пользователя; пересоздаётся при смене ключей или сети"""
+    with CLIENT_LOCK:
+        bx = CLIENTS.get(chat_id_str)
+    if _client_matches(bx, user_data):
+        return bx
+
+    # Конструктор ходит в сеть за server time — строим клиента без CLIENT_LOCK
+    new_bx = BingxClient(user_data.api_key, user_data.api_secret, testnet=user_data.testnet)
+    with CLIENT_LOCK:
+        bx = CLIENTS.get(chat_id_str)
+        if _client_matches(bx, user_data):
+            return bx  # параллельный поток успел раньше
+        CLIENTS[chat_id_str] = new_bx
+    return new_bx
+
+def drop_client(chat_id_str):
+    """Забыть клиента удалённого пользователя (вместе с его ключами)"""
+    with CLIENT_LOCK:
+        CLIENTS.pop(chat_id_str, None)
+
+def refresh_time_offsets():
+    """Фоновое обновление time_offset у закэшированных клиентов"""
+    while True:
+        time.sleep(TIME_OFFSET_REFRESH_SEC)
+        with CLIENT_LOCK:
+            clients = list(CLIENTS.values())
+        for bx in clients:
+            bx.time_offset = bx.get_server_time_offset()
 
 def open_trade_for_user(chat_id_str, signal):
     chat_id = int(chat_id_str)
@@ -225,37 +582,38 @@ def open_trade_for_user(chat_id_str, signal):
     symbol = signal["symbol"]
     price_now = signal["price_now"]
 
-    if symbol in user_data.get("blacklist", []):
+    if symbol in user_data.blacklist:
         logger.info(f"Skipped {symbol} for {chat_id} — in blacklist")
         return
 
     try:
-        bx = BingxClient(
-            user_data["api_key"],
-            user_data["api_secret"],
-            testnet=user_data.get("testnet", False)
-        )
+        bx = get_client(chat_id_str, user_data)
 
-        leverage_responce = bx.set_leverage(symbol, 'LONG', user_data.get("leverage", 10))
+        leverage_responce = bx.set_leverage(symbol, 'LONG', user_data.leverage)
         if leverage_responce.get('code') != 0:
-            leverage_responce = bx.set_leverage(symbol, 'LONG', user_data.get("leverage", 10), one_way_mode = True)
+            leverage_responce = bx.set_leverage(symbol, 'LONG', user_data.leverage, one_way_mode = True)
             
             
         s = symbol.replace('USDT', '-USDT')
-        qty = (user_data.get("margin_usdt", 50) * user_data.get("leverage", 10)) / price_now
-
-        stop_price = price_now * (1 - user_data.get("stop_loss_pct", 2.0) / 100)
-        precision = bx.count_decimal_places(price_now)
+        qty = (user_data.margin_usdt * user_data.leverage) / price_now
+
+        stop_price = price_now * (1 - user_data.stop_loss_pct / 100)
+        contract_precision = bx.get_precision(s)
+        if contract_precision:
+            precision, qty_precision = contract_precision
+        else:
+            precision = bx.count_decimal_places(price_now)
+            qty_precision = 0 if precision < 2 else 1
         stop_price = round(stop_price, precision)
 
         tp_prices = [
             round(price_now * (1 + p / 100), precision)
-            for p in user_data.get("take_profit_pcts", [4.0, 6.0])
+            for p in user_data.take_profit_pcts
         ]
-        qty = round(qty, 0 if precision < 2 else 1)
+        qty = round(qty, qty_precision)
 
-        if user_data.get("volume_filter_enabled", False):
-            if not check_volume_filter(symbol, user_data.get("volume_multiplier", 2.0)):
+        if user_data.volume_filter_enabled:
+            if not check_volume_filter(symbol, user_data.volume_multiplier):
                 logger.info(f"Volume filter blocked {symbol} for {chat_id}")
                 return
             
@@ -283,10 +641,12 @@ def open_trade_for_user(chat_id_str, signal):
 
         send_alert(chat_id, f"✅ Order placed on {symbol}. Period: {signal['period']}")
 
-        # Тейк-профиты
-        resp_tps = bx.set_multiple_tp(s, qty, bx.get_mark_price(s), 'long', tp_prices, one_way_mode)
+        # Тейк-профиты: цена исполнения из ответа ордера, иначе один запрос markPrice
+        order_info = (resp.get('data') or {}).get('order') or {}
+        mark_price = float(order_info.get('avgPrice') or 0) or bx.get_mark_price(s)
+        resp_tps = bx.set_multiple_tp(s, qty, mark_price, 'long', tp_prices, one_way_mode)
         if any(r.get('code') != 0 for r in resp_tps):
-            retry_resp = bx.set_multiple_tp(s, qty * 0.99, bx.get_mark_price(s), 'long', tp_prices, one_way_mode)
+            retry_resp = bx.set_multiple_tp(s, qty * 0.99, mark_price, 'long', tp_prices, one_way_mode)
             if any(r.get('code') != 0 for r in retry_resp):
                 r = bx.place_market_order('short', qty, s,pos_side_BOTH = one_way_mode, reduceOnly=True )
                 send_alert(chat_id, f"❌ TP placement failed → position closed {symbol}. {retry_resp}. Closing responce {r} ")
@@ -301,9 +661,9 @@ def open_trade_for_user(chat_id_str, signal):
             return
 
         # Trailing
-        if user_data.get("trailing_enabled", False):
-            act_price = price_now * (1 + user_data.get("trailing_activation_pct", 1.5) / 100)
-            trail_rate = round(user_data.get("trailing_rate_pct", 0.5) / 100, 3)
+        if user_data.trailing_enabled:
+            act_price = price_now * (1 + user_data.trailing_activation_pct / 100)
+            trail_rate = round(user_data.trailing_rate_pct / 100, 3)
             trail_resp = bx.set_trailing(s, 'long', qty, act_price, trail_rate)
             if trail_resp.get('code') != 0:
                 logger.warning(f"Trailing failed for {chat_id} {symbol}: {trail_resp}")
@@ -327,6 +687,30 @@ def open_trade_for_user(chat_id_str, signal):
     TRAILING_ACTIVATION, TRAILING_RATE, VOLUME_MULTIPLIER, 
 ) = range(11)
 
+def _setting_prompt(data):
+    field = data.replace('set_', '').replace('_', ' ').title()
+    return f"Введите новое значение для <b>{field}</b>:"
+
+# callback_data -> (поле-переключатель | None, состояние диалога | None, текст запроса | None)
+DISPATCH = {
+    'toggle_trading': ('trading_enabled', None, None),
+    'toggle_testnet': ('testnet', None, None),
+    'toggle_trailing': ('trailing_enabled', None, None),
+    'toggle_volume_filter': ('volume_filter_enabled', None, None),
+    'toggle_4h': ('signals_4h_enabled', None, None),
+    'toggle_24h': ('signals_24h_enabled', None, None),
+    'set_api_key': (None, API_KEY, _setting_prompt('set_api_key')),
+    'set_api_secret': (None, API_SECRET, _setting_prompt('set_api_secret')),
+    'set_leverage': (None, LEVERAGE, _setting_prompt('set_leverage')),
+    'set_margin': (None, MARGIN, _setting_prompt('set_margin')),
+    'set_sl': (None, STOP_LOSS, _setting_prompt('set_sl')),
+    'set_tp_list': (None, TP_LIST, _setting_prompt('set_tp_list')),
+    'set_trail_act': (None, TRAILING_ACTIVATION, _setting_prompt('set_trail_act')),
+    'set_trail_rate': (None, TRAILING_RATE, _setting_prompt('set_trail_rate')),
+    'set_volume_multiplier': (None, VOLUME_MULTIPLIER, _setting_prompt('set_volume_multiplier')),
+    'set_price_oi_ratio': (None, PRICE_OI_RATIO_STATE, "Введите коэффициент PRICE → OI (например 0.5):"),
+}
+
 WELCOME_MESSAGE = """
 Добро пожаловать в OI Alert Bot v2!
 Автор: @Perpetual_god
@@ -359,24 +743,21 @@ WELCOME_MESSAGE = """
 /blacklist_add /blacklist_remove /blacklist_show
 """
 
+NOT_SUBSCRIBED_TEXT = "Подписка отключена. Отправьте /start, чтобы включить бота снова"
+
+def _user(chat_id):
+    """Настройки чата; для нового чата создаются и сохраняются настройки по умолчанию.
+    Только для /start и /blacklist_add: кнопки и ввод после /stop подписку не возвращают"""
+    with USERS_LOCK:
+        user = users.get(chat_id)
+        if user is None:
+            user = users[chat_id] = UserCfg()
+            schedule_save(chat_id)
+        return user
+
 def start(update: Update, context):
     chat_id = str(update.effective_chat.id)
-    if chat_id not in users:
-        users[chat_id] = {
-            "trading_enabled": False,
-            "testnet": False,
-            "api_key": "", "api_secret": "",
-            "leverage": 10, "margin_usdt": 50,
-            "signals_4h_enabled": True,
-            "signals_24h_enabled": True,
-            "price_oi_ratio": 0.5,
-            "stop_loss_pct": 2.0, "take_profit_pcts": [4.0, 6.0],
-            "trailing_enabled": False,
-            "trailing_activation_pct": 1.5, "trailing_rate_pct": 0.5,
-            "volume_filter_enabled": False, "volume_multiplier": 2.0,
-            "blacklist": [], "last_signal_time": {}
-        }
-        save_users(users)
+    _user(chat_id)
 
     update.message.reply_text(WELCOME_MESSAGE)
     return show_settings_menu(update, context)
@@ -386,51 +767,93 @@ def help_command(update: Update, context):
 
 def stop(update: Update, context):
     chat_id = str(update.effective_chat.id)
-    if chat_id in users:
-        del users[chat_id]
-        save_users(users)
+    with USERS_LOCK:
+        removed = users.pop(chat_id, None)
+    _KB_CACHE.pop(chat_id, None)
+    drop_client(chat_id)
+    if removed is not None:
+        schedule_save(chat_id)
     update.message.reply_text("Подписка отключена")
     return ConversationHandler.END
 
 def settings(update: Update, context):
     return show_settings_menu(update, context)
 
-def show_settings_menu(update: Update, context):
-    chat_id = str(update.effective_chat.id if update.message else update.callback_query.message.chat_id)
-    user = users.get(chat_id, {})
+# chat_id -> (signature, InlineKeyboardMarkup): меню пересобирается только при изменении настроек
+_KB_CACHE = {}
+
+def _settings_signature(user):
+    return (
+        user.trading_enabled,
+        bool(user.api_key),
+        bool(user.api_secret),
+        user.testnet,
+        user.leverage,
+        user.margin_usdt,
+        user.signals_4h_enabled,
+        user.signals_24h_enabled,
+        user.price_oi_ratio,
+        user.stop_loss_pct,
+        tuple(user.take_profit_pcts),
+        user.trailing_enabled,
+        user.trailing_activation_pct,
+        user.trailing_rate_pct,
+        user.volume_filter_enabled,
+        user.volume_multiplier,
+    )
+
+def _build_settings_markup(sig):
+    (trading, api_key, api_secret, testnet, leverage, margin, signals_4h, signals_24h, price_oi_ratio,
+     stop_loss, take_profits, trailing, trail_act, trail_rate, volume_filter, volume_multiplier) = sig
 
     keyboard = [
-        [InlineKeyboardButton(f"⚙️ Торговля: {'✅' if user.get('trading_enabled') else '❌'}", callback_data='toggle_trading')],
-        [InlineKeyboardButton(f"🔑 API Key: {'✅' if user.get('api_key') else '❌'}", callback_data='set_api_key')],
-        [InlineKeyboardButton(f"🔒 API Secret: {'✅' if user.get('api_secret') else '❌'}", callback_data='set_api_secret')],
-        [InlineKeyboardButton(f"🌐 Сеть: {'Testnet' if user.get('testnet') else 'Real'}", callback_data='toggle_testnet')],
-        [InlineKeyboardButton(f"📈 Плечо: {user.get('leverage', 10)}x", callback_data='set_leverage')],
-        [InlineKeyboardButton(f"💰 Маржа: {user.get('margin_usdt', 50)} USDT", callback_data='set_margin')],
+        [InlineKeyboardButton(f"⚙️ Торговля: {'✅' if trading else '❌'}", callback_data='toggle_trading')],
+        [InlineKeyboardButton(f"🔑 API Key: {'✅' if api_key else '❌'}", callback_data='set_api_key')],
+        [InlineKeyboardButton(f"🔒 API Secret: {'✅' if api_secret else '❌'}", callback_data='set_api_secret')],
+        [InlineKeyboardButton(f"🌐 Сеть: {'Testnet' if testnet else 'Real'}", callback_data='toggle_testnet')],
+        [InlineKeyboardButton(f"📈 Плечо: {leverage}x", callback_data='set_leverage')],
+        [InlineKeyboardButton(f"💰 Маржа: {margin} USDT", callback_data='set_margin')],
         [InlineKeyboardButton(
-            f"⏱ 4H сигналы: {'✅' if user.get('signals_4h_enabled', True) else '❌'}",
+            f"⏱ 4H сигналы: {'✅' if signals_4h else '❌'}",
             callback_data='toggle_4h'
         )],
         [InlineKeyboardButton(
-            f"⏱ 24H сигналы: {'✅' if user.get('signals_24h_enabled', True) else '❌'}",
+            f"⏱ 24H сигналы: {'✅' if signals_24h else '❌'}",
             callback_data='toggle_24h'
         )],
         [InlineKeyboardButton(
-            f"📐 PRICE→OI: {user.get('price_oi_ratio', 0.5)}",
+            f"📐 PRICE→OI: {price_oi_ratio}",
             callback_data='set_price_oi_ratio'
         )],
-        [InlineKeyboardButton(f"🛑 SL: {user.get('stop_loss_pct', 2.0)}%", callback_data='set_sl')],
-        [InlineKeyboardButton(f"🎯 TP: {','.join(map(str, user.get('take_profit_pcts', [4,6])))}%", callback_data='set_tp_list')],
-        [InlineKeyboardButton(f"📉 Трейлинг: {'✅' if user.get('trailing_enabled') else '❌'}", callback_data='toggle_trailing')],
-        [InlineKeyboardButton(f"🚀 Активация трейлинга: {user.get('trailing_activation_pct', 1.5)}%", callback_data='set_trail_act')],
-        [InlineKeyboardButton(f"📊 Price Rate: {user.get('trailing_rate_pct', 0.5)}%", callback_data='set_trail_rate')],
-        [InlineKeyboardButton(f"🔍 Volume filter: {'✅' if user.get('volume_filter_enabled') else '❌'}", callback_data='toggle_volume_filter')],
-        [InlineKeyboardButton(f"📶 Volume x{user.get('volume_multiplier', 2.0)}", callback_data='set_volume_multiplier')],
+        [InlineKeyboardButton(f"🛑 SL: {stop_loss}%", callback_data='set_sl')],
+        [InlineKeyboardButton(f"🎯 TP: {','.join(map(str, take_profits))}%", callback_data='set_tp_list')],
+        [InlineKeyboardButton(f"📉 Трейлинг: {'✅' if trailing else '❌'}", callback_data='toggle_trailing')],
+        [InlineKeyboardButton(f"🚀 Активация трейлинга: {trail_act}%", callback_data='set_trail_act')],
+        [InlineKeyboardButton(f"📊 Price Rate: {trail_rate}%", callback_data='set_trail_rate')],
+        [InlineKeyboardButton(f"🔍 Volume filter: {'✅' if volume_filter else '❌'}", callback_data='toggle_volume_filter')],
+        [InlineKeyboardButton(f"📶 Volume x{volume_multiplier}", callback_data='set_volume_multiplier')],
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+def show_settings_menu(update: Update, context):
+    chat_id = str(update.effective_chat.id if update.message else update.callback_query.message.chat_id)
+    user = users.get(chat_id, _DEFAULT_CFG)
+
+    sig = _settings_signature(user)
+    cached = _KB_CACHE.get(chat_id)
+    if cached is not None and cached[0] == sig:
+        reply_markup = cached[1]
+    else:
+        reply_markup = _build_settings_markup(sig)
+        _KB_CACHE[chat_id] = (sig, reply_markup)
 
     text = "<b>⚙️ Настройки торгового бота</b>"
 
     if update.callback_query:
+        # Сообщение уже показывает эти же настройки — не гоняем edit_message_text в Telegram
+        rendered = (update.callback_query.message.message_id, sig)
+        if context.chat_data.get('settings_rendered') == rendered:
+            return ConversationHandler.END
         try:
             update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode="HTML")
         except Exception as e:
@@ -438,69 +861,58 @@ def show_settings_menu(update: Update, context):
                 pass
             else:
                 raise
+        context.chat_data['settings_rendered'] = rendered
     else:
-        update.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
+        message = update.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
+        context.chat_data['settings_rendered'] = (message.message_id, sig)
 
     return ConversationHandler.END
 
 def blacklist_show(update: Update, context):
     chat_id = str(update.effective_chat.id)
-    blacklist = users.get(chat_id, {}).get("blacklist", [])
+    blacklist = users.get(chat_id, _DEFAULT_CFG).blacklist
     if not blacklist:
         update.message.reply_text("Чёрный список пуст")
         return
     text = "<b>Чёрный список:</b>\n\n" + "\n".join(f"• {s}" for s in sorted(blacklist))
     update.message.reply_text(text, parse_mode="HTML")
 
+def _update_user(chat_id, update_func):
+    """Изменить настройки подписанного чата; False — чата нет (был /stop)"""
+    with USERS_LOCK:
+        user = users.get(chat_id)
+        if user is None:
+            return False
+        update_func(user)
+    schedule_save(chat_id)
+    return True
+
+def _toggle(chat_id, key):
+    return _update_user(chat_id, lambda user: setattr(user, key, not getattr(user, key)))
+
 def button_handler(update: Update, context):
     query = update.callback_query
     query.answer()
     chat_id = str(query.message.chat_id)
     data = query.data
 
-    if data == 'toggle_trading':
-        users[chat_id]['trading_enabled'] = not users[chat_id].get('trading_enabled', False)
-    elif data == 'toggle_testnet':
-        users[chat_id]['testnet'] = not users[chat_id].get('testnet', False)
-    elif data == 'toggle_trailing':
-        users[chat_id]['trailing_enabled'] = not users[chat_id].get('trailing_enabled', False)
-    elif data == 'toggle_volume_filter':
-        users[chat_id]['volume_filter_enabled'] = not users[chat_id].get('volume_filter_enabled', False)
-    elif data.startswith('set_'):
-        context.user_data['setting'] = data
-        field = data.replace('set_', '').replace('_', ' ').title()
-        query.edit_message_text(f"Введите новое значение для <b>{field}</b>:", parse_mode="HTML")
-        return get_state(data)
-    elif data == 'toggle_4h':
-        users[chat_id]['signals_4h_enabled'] = not users[chat_id].get('signals_4h_enabled', True)
-
-    elif data == 'toggle_24h':
-        users[chat_id]['signals_24h_enabled'] = not users[chat_id].get('signals_24h_enabled', True)
-
-    elif data == 'set_price_oi_ratio':
-        context.user_data['setting'] = 'set_price_oi_ratio'
-        query.edit_message_text(
-            "Введите коэффициент PRICE → OI (например 0.5):"
-        )
-        return PRICE_OI_RATIO_STATE
+    entry = DISPATCH.get(data)
+    if entry is None:
+        return show_settings_menu(update, context)
 
-    save_users(users)
-    return show_settings_menu(update, context)
+    toggle, state, prompt = entry
+    if chat_id not in users or (toggle is not None and not _toggle(chat_id, toggle)):
+        # Кнопка из старого меню после /stop
+        context.chat_data.pop('settings_rendered', None)
+        query.edit_message_text(NOT_SUBSCRIBED_TEXT)
+        return ConversationHandler.END
+    if toggle is not None:
+        return show_settings_menu(update, context)
 
-def get_state(data: str) -> int:
-    mapping = {
-        'set_api_key': API_KEY,
-        'set_api_secret': API_SECRET,
-        'set_leverage': LEVERAGE,
-        'set_margin': MARGIN,
-        'set_sl': STOP_LOSS,
-        'set_tp_list': TP_LIST,
-        'set_trail_act': TRAILING_ACTIVATION,
-        'set_trail_rate': TRAILING_RATE,
-        'set_volume_multiplier': VOLUME_MULTIPLIER,
-        
-    }
-    return mapping.get(data, ConversationHandler.END)
+    context.user_data['setting'] = data
+    context.chat_data.pop('settings_rendered', None)  # меню в этом сообщении заменяется запросом
+    query.edit_message_text(prompt, parse_mode="HTML")
+    return state
 
 def set_value(update: Update, context, key: str, type_func):
     chat_id = str(update.effective_chat.id)
@@ -508,38 +920,29 @@ def set_value(update: Update, context, key: str, type_func):
 
     try:
         value = type_func(text)
-        users[chat_id][key] = value
-        save_users(users)
-        update.message.reply_text(f"{key.replace('_', ' ').title()} установлен: {value}")
     except ValueError:
         update.message.reply_text("Неверный формат. Попробуйте снова.")
-        return get_state(context.user_data.get('setting', ''))
+        return DISPATCH.get(context.user_data.get('setting'), (None, ConversationHandler.END, None))[1]
 
+    if not _update_user(chat_id, lambda user: setattr(user, key, value)):
+        update.message.reply_text(NOT_SUBSCRIBED_TEXT)
+        return ConversationHandler.END
+    update.message.reply_text(f"{key.replace('_', ' ').title()} установлен: {value}")
     return show_settings_menu(update, context)
 
-def set_api_key(update: Update, context):
-    return set_value(update, context, 'api_key', str)
-
-def set_api_secret(update: Update, context):
-    return set_value(update, context, 'api_secret', str)
-
-def set_leverage(update: Update, context):
-    return set_value(update, context, 'leverage', int)
-
-def set_margin(update: Update, context):
-    return set_value(update, context, 'margin_usdt', float)
-
-def set_sl(update: Update, context):
-    return set_value(update, context, 'stop_loss_pct', float)
+def _make_setter(key: str, type_func):
+    def handler(update: Update, context):
+        return set_value(update, context, key, type_func)
+    return handler
 
-def set_trail_act(update: Update, context):
-    return set_value(update, context, 'trailing_activation_pct', float)
-
-def set_trail_rate(update: Update, context):
-    return set_value(update, context, 'trailing_rate_pct', float)
-
-def set_volume_multiplier(update: Update, context):
-    return set_value(update, context, 'volume_multiplier', float)
+set_api_key = _make_setter('api_key', str)
+set_api_secret = _make_setter('api_secret', str)
+set_leverage = _make_setter('leverage', int)
+set_margin = _make_setter('margin_usdt', float)
+set_sl = _make_setter('stop_loss_pct', float)
+set_trail_act = _make_setter('trailing_activation_pct', float)
+set_trail_rate = _make_setter('trailing_rate_pct', float)
+set_volume_multiplier = _make_setter('volume_multiplier', float)
 
 def set_tp_list(update: Update, context):
     chat_id = str(update.effective_chat.id)
@@ -547,12 +950,14 @@ def set_tp_list(update: Update, context):
         tp_list = [float(x) for x in update.message.text.replace(' ', '').split(',')]
         if not tp_list or any(x <= 0 for x in tp_list):
             raise ValueError
-        users[chat_id]['take_profit_pcts'] = tp_list
-        save_users(users)
-        update.message.reply_text(f"Take Profits: {tp_list}%")
     except:
         update.message.reply_text("Формат: 4,6,8")
         return TP_LIST
+
+    if not _update_user(chat_id, lambda user: setattr(user, 'take_profit_pcts', tp_list)):
+        update.message.reply_text(NOT_SUBSCRIBED_TEXT)
+        return ConversationHandler.END
+    update.message.reply_text(f"Take Profits: {tp_list}%")
     return show_settings_menu(update, context)
 
 def blacklist_add(update: Update, context):
@@ -561,10 +966,12 @@ def blacklist_add(update: Update, context):
         return
     symbol = context.args[0].upper()
     chat_id = str(update.effective_chat.id)
-    users.setdefault(chat_id, {})["blacklist"] = users[chat_id].get("blacklist", [])
-    if symbol not in users[chat_id]["blacklist"]:
-        users[chat_id]["blacklist"].append(symbol)
-        save_users(users)
+    with USERS_LOCK:
+        blacklist = _user(chat_id).blacklist
+        added = symbol not in blacklist
+        blacklist.add(symbol)
+    if added:
+        schedule_save(chat_id)
     update.message.reply_text(f"{symbol} добавлен в чёрный список")
 
 def blacklist_remove(update: Update, context):
@@ -573,20 +980,24 @@ def blacklist_remove(update: Update, context):
         return
     symbol = context.args[0].upper()
     chat_id = str(update.effective_chat.id)
-    if symbol in users.get(chat_id, {}).get("blacklist", []):
-        users[chat_id]["blacklist"].remove(symbol)
-        save_users(users)
+    with USERS_LOCK:
+        blacklist = users.get(chat_id, _DEFAULT_CFG).blacklist
+        removed = symbol in blacklist
+        if removed:
+            blacklist.discard(symbol)
+    if removed:
+        schedule_save(chat_id)
     update.message.reply_text(f"{symbol} удалён из чёрного списка")
 
 def stats(update: Update, context):
     chat_id = str(update.effective_chat.id)
     user_data = users.get(chat_id)
-    if not user_data or not user_data.get("api_key"):
+    if not user_data or not user_data.api_key:
         update.message.reply_text("API не настроен")
         return
 
     try:
-        bx = BingxClient(user_data["api_key"], user_data["api_secret"], user_data.get("testnet", False))
+        bx = get_client(chat_id, user_data)
         positions = bx.get_positions()
         open_pos = [p for p in positions if abs(float(p.get('positionAmt', 0))) > 0]
         unrealized = sum(float(p.get('unrealizedProfit', 0)) for p in open_pos)
@@ -617,13 +1028,14 @@ def set_price_oi_ratio(update: Update, context):
         value = float(update.message.text)
         if not (0 < value <= 2):
             raise ValueError
-        users[chat_id]['price_oi_ratio'] = value
-        save_users(users)
-        update.message.reply_text(f"PRICE → OI коэффициент установлен: {value}")
     except:
         update.message.reply_text("Введите число, например 0.5")
         return PRICE_OI_RATIO_STATE
 
+    if not _update_user(chat_id, lambda user: setattr(user, 'price_oi_ratio', value)):
+        update.message.reply_text(NOT_SUBSCRIBED_TEXT)
+        return ConversationHandler.END
+    update.message.reply_text(f"PRICE → OI коэффициент установлен: {value}")
     return show_settings_menu(update, context)
 
 
@@ -661,7 +1073,20 @@ def telegram_bot():
     dp.add_handler(conv_handler)
     dp.add_handler(CommandHandler("stop", stop))
 
-    # Установка списка команд для / в Telegram
+    updater.start_polling()
+    sync_bot_commands()
+
+# Меняйте версию при изменении списка команд — тогда он будет заново отправлен в Telegram
+COMMANDS_VERSION = "v2-2024"
+
+def sync_bot_commands():
+    """Установка списка команд для / в Telegram, только если он изменился с прошлого запуска"""
+    try:
+        if COMMANDS_VERSION_FILE.read_text(encoding="utf-8").strip() == COMMANDS_VERSION:
+            return
+    except OSError:
+        pass
+
     commands = [
         BotCommand("start", "Запустить бота"),
         BotCommand("settings", "Настройки"),
@@ -672,32 +1097,47 @@ def telegram_bot():
         BotCommand("blacklist_remove", "Удалить из blacklist"),
         BotCommand("blacklist_show", "Показать blacklist"),
     ]
-    bot.set_my_commands(commands)
-
-    updater.start_polling()
+    try:
+        bot.set_my_commands(commands)
+        COMMANDS_VERSION_FILE.write_text(COMMANDS_VERSION, encoding="utf-8")
+    except Exception as e:
+        logger.error(f"Failed to set bot commands: {e}")
 
 # Запуск Telegram-бота в отдельном потоке
 threading.Thread(target=telegram_bot, daemon=True).start()
+threading.Thread(target=refresh_time_offsets, daemon=True).start()
+threading.Thread(target=signal_notifier, daemon=True).start()
 
 def main():
-    symbols = get_symbols()
-    logger.info(f"Loaded {len(symbols)} perpetual symbols")
-
+    # Сканы идут с фиксированным шагом от абсолютного дедлайна, без накопления дрейфа
+    next_deadline = time.monotonic()
     while True:
-        start_time = time.time()
-        logger.info("Scan started")
-
-        signals = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            futures = {executor.submit(check_symbol, s): s for s in symbols}
-            for future in concurrent.futures.as_completed(futures):
-                signal = future.result()
-                if signal:
-                    signals.append(signal)
-
-        elapsed = time.time() - start_time
-        sleep_time = max(60, CHECK_INTERVAL_MIN * 60 - elapsed)
-        time.sleep(sleep_time)
+        symbols = get_symbols()
+        now = time.time()
+        with _PENDING_LOCK:
+            pending = set(_PENDING)
+        # Символы с недавно разосланным или ещё ждущим рассылки сигналом пропускаем до HTTP-запросов
+        symbols_to_scan = [s for s in symbols
+                           if s not in pending and now - _COOLDOWN.get(s, 0) > SYMBOL_COOLDOWN_SEC]
+        logger.info(f"Scan started: {len(symbols_to_scan)}/{len(symbols)} perpetual symbols")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+            # Пользовательская часть работает только по символам, прошедшим пороги OI;
+            # рассылка идёт в signal_notifier и не тормозит сам скан
+            for metrics in executor.map(get_symbol_metrics, symbols_to_scan):
+                if metrics is not None and passes_oi_thresholds(metrics):
+                    with _PENDING_LOCK:
+                        _PENDING.add(metrics["symbol"])
+                    SIGNAL_QUEUE.put(metrics)
+
+        next_deadline += CHECK_INTERVAL_MIN * 60
+        delay = next_deadline - time.monotonic()
+        if delay <= 0:
+            # Скан не уложился в интервал: пропускаем упущенные слоты и начинаем сразу
+            logger.warning(f"Scan overran interval by {-delay:.1f}s")
+            next_deadline = time.monotonic()
+        else:
+            time.sleep(delay)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file